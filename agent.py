@@ -11,9 +11,184 @@ This is the main agent orchestrator that coordinates:
 
 import json
 import os
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import subprocess
+import select
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from secrets import token_hex
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import subprocess  # Imported lazily, when the first MCP client starts
+
+import numpy as np
+
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:  # orjson is faster, but the stdlib encoder works too
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _json_loads = json.loads
+
+# Bound once so hot paths skip the datetime attribute lookup
+_datetime_now = datetime.now
+
+# Seconds to wait for an MCP tool response before dropping the client
+MCP_TIMEOUT_SECONDS = 30
+
+# Maximum rows sent to Google Sheets in a single batched MCP call
+SHEETS_BATCH_SIZE = 100
+
+# Maximum messages sent in a single batched Gmail MCP call
+GMAIL_BATCH_SIZE = 100
+
+# Concurrent AI requests per campaign (each worker gets its own MCP client)
+CAMPAIGN_WORKERS = 16
+
+# Customers a campaign loop lets AI generation run ahead by
+PREFETCH_WINDOW = 4 * CAMPAIGN_WORKERS
+
+# Distinct AI prompts remembered per agent (see _prompt_signature)
+PROMPT_CACHE_SIZE = 4096
+
+# AI prompt templates, filled from a prompt signature with str.format_map
+_WE_MISS_YOU_PROMPT = (
+    "Write a friendly marketing message in Vietnamese for a loyal customer.\n"
+    "Do not include a greeting or the customer's name.\n"
+    "Campaign type: {campaign_type}\n"
+    "Customer details:\n"
+    "- Favorite drink: {drink}\n"
+    "- Total visits: {visits}\n"
+    "\n"
+    "Keep it warm, casual, and under 100 words.\n"
+    "Include a special 15% discount offer.\n"
+)
+
+# Marketing message prompt per campaign type
+_MESSAGE_PROMPTS = {
+    "we_miss_you": _WE_MISS_YOU_PROMPT
+}
+
+_RECOMMENDATION_PROMPT = (
+    "Based on this customer's purchase history, recommend 2-3 new drinks they might enjoy:\n"
+    "- Favorite drink: {drink}\n"
+    "- Total visits: {visits}\n"
+    "\n"
+    "Respond with just the drink names, one per line.\n"
+)
+
+# How long a formatted "now" timestamp is reused (see _now_iso)
+TIMESTAMP_CACHE_SECONDS = 0.25
+
+# Visit counts that earn a milestone reward
+_MILESTONES = frozenset({5, 10, 25, 50, 100})
+
+# Menu items, indexed by the "item_id" column of sales data
+MENU_ITEMS = (
+    "Taro Milk Tea",
+    "Brown Sugar Boba",
+    "Mango Smoothie",
+    "Classic Milk Tea",
+    "Matcha Latte",
+    "Passion Fruit Green Tea",
+)
+
+# Sales data is columnar: one NumPy array per field
+SalesColumns = Dict[str, np.ndarray]
+
+# Fixed dtype of each sales column (see BobaBotAgent._get_sales_data)
+SALES_DTYPES = {
+    "amount": np.float64,
+    "hour": np.int8,
+    "is_loyalty": np.bool_,
+    "item_id": np.int32
+}
+
+# Accepted input dtype kinds and inclusive value range of each sales column
+SALES_COLUMN_RULES = {
+    "amount": ("iuf", None),
+    "hour": ("iu", (0, 23)),
+    "is_loyalty": ("biu", (0, 1)),
+    "item_id": ("iu", (0, len(MENU_ITEMS) - 1))
+}
+
+
+def _hour_label(hour: int) -> str:
+    """Format an hour of the day as e.g. "2pm"."""
+    return f"{hour % 12 or 12}{'am' if hour % 24 < 12 else 'pm'}"
+
+
+def _top_k(counts: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k largest non-zero counts, largest first.
+    
+    Ties are broken by lower index. Histograms here have at most a few
+    dozen buckets, so a stable full sort costs nothing over a partition.
+    """
+    top = np.argsort(-counts, kind="stable")[:k]
+    return top[counts[top] > 0]
+
+
+def _stop_mcp_process(proc: "subprocess.Popen"):
+    """Stop an MCP client process and reap it."""
+    import subprocess
+    
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def _stop_idle_mcp_processes(idle: list, lock: threading.Lock):
+    """
+    Stop every process in an agent's idle MCP pool.
+    
+    Module level so the agent's finalizer can run it without keeping
+    the agent itself alive.
+    """
+    with lock:
+        procs = idle[:]
+        idle.clear()
+    for proc in procs:
+        _stop_mcp_process(proc)
+
+
+# Labels for the 2-hour windows used in peak hour reporting
+PEAK_WINDOW_LABELS = tuple(f"{_hour_label(h)}-{_hour_label(h + 2)}" for h in range(0, 24, 2))
+
+
+@dataclass(slots=True)
+class Customer:
+    """
+    Loyalty program customer profile.
+    
+    Slotted to keep per-profile memory small and attribute access fast.
+    """
+    id: str
+    name: Optional[str]
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    favorite_drink: Optional[str] = None
+    birthday: Optional[str] = None  # "YYYY-MM-DD"
+    signup_date: Optional[str] = None
+    total_visits: int = 0
+    total_spent: float = 0.0
+    loyalty_points: int = 100  # Welcome bonus
+    last_visit: Optional[str] = None
+    last_visit_epoch: Optional[int] = None  # last_visit as Unix seconds, for cohort filters
+    status: str = "active"
+    
+    def to_dict(self) -> Dict:
+        """Convert to a plain dict for MCP tool parameters."""
+        return asdict(self)
 
 class BobaBotAgent:
     """
@@ -23,34 +198,55 @@ class BobaBotAgent:
     def __init__(self):
         self.version = "1.0.0-alpha"
         self.mcp_server = "zapier"
-        self.customers_db = []  # Will be Google Sheets in production
+        self._customers: Dict[str, Customer] = {}  # Local index by ID; Google Sheets is the store of record
+        self._iso_cache = None  # Last formatted timestamp, see _now_iso()
+        self._iso_time = None
+        self._customer_frame = None  # Columnar snapshot of _customers, see _refresh_customer_frame()
+        self._now = None  # Clock for cohort queries, set by _get_customer_frame()
+        self._now_epoch = None
         self.campaigns = []
+        self._mcp_idle = []  # Persistent MCP clients not currently in use
+        self._mcp_lock = threading.Lock()
+        # Stops idle clients when the agent is collected or at interpreter exit
+        self._mcp_finalizer = weakref.finalize(self, _stop_idle_mcp_processes, self._mcp_idle, self._mcp_lock)
+        self._pending_customer_writes = []
+        self._pending_customer_updates = {}  # Keyed by customer ID, latest wins
+        self._pending_report_writes = []
+        self._pending_sends = []  # (customer, message) pairs, see _flush_sends()
+        self._batch_depth = 0  # > 0 while inside batched_writes()
+        
+        # Per-tool MCP request functions, see _build_tool_caller()
+        self._tool_caller = lru_cache(maxsize=32)(self._build_tool_caller)
+        
+        # AI responses cached per prompt signature, per agent instance
+        self._cached_message_text = lru_cache(maxsize=PROMPT_CACHE_SIZE)(self._generate_message_text)
+        self._cached_recommendations = lru_cache(maxsize=PROMPT_CACHE_SIZE)(self._generate_recommendations)
         
     # ==================== CUSTOMER DATA MANAGEMENT ====================
     
-    def capture_customer(self, customer_data: Dict) -> Dict:
+    def capture_customer(self, customer_data: Dict) -> Customer:
         """
         Capture new customer data from QR code sign-up.
         
         Args:
-            customer_data: Dict with keys: name, phone, email, favorite_drink
+            customer_data: Dict with keys: name, phone, email, favorite_drink,
+                and optionally birthday ("YYYY-MM-DD"; invalid values are ignored)
             
         Returns:
             Customer profile with assigned ID and loyalty points
         """
-        customer = {
-            "id": self._generate_customer_id(),
-            "name": customer_data.get("name"),
-            "phone": customer_data.get("phone"),
-            "email": customer_data.get("email"),
-            "favorite_drink": customer_data.get("favorite_drink"),
-            "signup_date": datetime.now().isoformat(),
-            "total_visits": 0,
-            "total_spent": 0.0,
-            "loyalty_points": 100,  # Welcome bonus
-            "last_visit": None,
-            "status": "active"
-        }
+        customer = Customer(
+            id=self._generate_customer_id(),
+            name=customer_data.get("name"),
+            phone=customer_data.get("phone"),
+            email=customer_data.get("email"),
+            favorite_drink=customer_data.get("favorite_drink"),
+            birthday=self._normalize_birthday(customer_data.get("birthday")),
+            signup_date=self._now_iso()
+        )
+        
+        self._customers[customer.id] = customer
+        self._customer_frame = None
         
         # Store in Google Sheets via Zapier MCP
         self._store_customer_in_sheets(customer)
@@ -60,7 +256,7 @@ class BobaBotAgent:
         
         return customer
     
-    def track_purchase(self, customer_id: str, purchase_data: Dict) -> Dict:
+    def track_purchase(self, customer_id: str, purchase_data: Dict) -> Customer:
         """
         Track a customer purchase and update their profile.
         
@@ -74,13 +270,15 @@ class BobaBotAgent:
         customer = self._get_customer(customer_id)
         
         # Update customer stats
-        customer["total_visits"] += 1
-        customer["total_spent"] += purchase_data["total_amount"]
-        customer["last_visit"] = datetime.now().isoformat()
+        customer.total_visits += 1
+        customer.total_spent += purchase_data["total_amount"]
+        customer.last_visit = self._now_iso()
+        customer.last_visit_epoch = int(time.time())
+        self._customer_frame = None
         
         # Calculate loyalty points (1 point per dollar spent)
         points_earned = int(purchase_data["total_amount"])
-        customer["loyalty_points"] += points_earned
+        customer.loyalty_points += points_earned
         
         # Update in Google Sheets
         self._update_customer_in_sheets(customer)
@@ -101,14 +299,18 @@ class BobaBotAgent:
         """
         results = []
         
-        # Campaign 1: "We Miss You" - Inactive customers
-        results.append(self._run_we_miss_you_campaign())
-        
-        # Campaign 2: Birthday rewards
-        results.append(self._run_birthday_campaign())
+        # Load customers once; all three cohorts filter this snapshot
+        self._refresh_customer_frame()
         
-        # Campaign 3: Personalized recommendations
-        results.append(self._run_recommendation_campaign())
+        with self.batched_writes():
+            # Campaign 1: "We Miss You" - Inactive customers
+            results.append(self._run_we_miss_you_campaign())
+            
+            # Campaign 2: Birthday rewards
+            results.append(self._run_birthday_campaign())
+            
+            # Campaign 3: Personalized recommendations
+            results.append(self._run_recommendation_campaign())
         
         return results
     
@@ -125,22 +327,36 @@ class BobaBotAgent:
             "errors": 0
         }
         
-        for customer in inactive_customers:
+        # AI messages are generated ahead of the loop, concurrently
+        prefetched = self._iter_prefetched(
+            self._message_text,
+            inactive_customers,
+            campaign_type="we_miss_you"
+        )
+        
+        outgoing = []
+        queued = failed = 0
+        for customer, text in prefetched:
             try:
-                # Generate personalized message using Vertex AI
-                message = self._generate_personalized_message(
-                    customer=customer,
-                    campaign_type="we_miss_you"
-                )
+                # Personalize the message generated using Vertex AI
+                message = self._personalize_message(customer, text.result())
                 
-                # Send via Gmail/SMS
-                self._send_message(customer, message)
-                
-                results["messages_sent"] += 1
+                outgoing.append((customer, message))
                 
             except Exception as e:
-                print(f"Error sending to {customer['name']}: {e}")
+                print(f"Error sending to {customer.name}: {e}")
                 results["errors"] += 1
+            
+            # Send via Gmail/SMS in batches, while generation runs ahead
+            if len(outgoing) == GMAIL_BATCH_SIZE:
+                queued += len(outgoing)
+                failed += self._send_messages(outgoing)
+                outgoing = []
+        
+        queued += len(outgoing)
+        failed += self._send_messages(outgoing)
+        results["messages_sent"] = queued - failed
+        results["errors"] += failed
         
         return results
     
@@ -153,22 +369,27 @@ class BobaBotAgent:
         results = {
             "campaign": "Birthday Rewards",
             "target_count": len(birthday_customers),
-            "rewards_sent": 0
+            "rewards_sent": 0,
+            "errors": 0
         }
         
+        outgoing = []
         for customer in birthday_customers:
             # Generate birthday offer
             offer = {
                 "type": "free_drink",
-                "item": customer.get("favorite_drink", "Any drink"),
+                "item": customer.favorite_drink or "Any drink",
                 "expiry_days": 7
             }
             
             # Send birthday message
             message = self._generate_birthday_message(customer, offer)
-            self._send_message(customer, message)
-            
-            results["rewards_sent"] += 1
+            outgoing.append((customer, message))
+        
+        # Send via Gmail/SMS in batches
+        failed = self._send_messages(outgoing)
+        results["rewards_sent"] = len(outgoing) - failed
+        results["errors"] = failed
         
         return results
     
@@ -182,20 +403,72 @@ class BobaBotAgent:
         results = {
             "campaign": "Personalized Recommendations",
             "target_count": len(recent_customers),
-            "recommendations_sent": 0
+            "recommendations_sent": 0,
+            "errors": 0
         }
         
-        for customer in recent_customers:
+        prefetched = self._iter_prefetched(
+            self._recommendations_for,
+            recent_customers,
+            campaign_type="recommendation"
+        )
+        
+        outgoing = []
+        queued = failed = 0
+        for customer, recommendations in prefetched:
             # Use AI to analyze purchase history and recommend new items
-            recommendations = self._get_ai_recommendations(customer)
+            recommendations = list(recommendations.result())
             
             if recommendations:
                 message = self._generate_recommendation_message(customer, recommendations)
-                self._send_message(customer, message)
-                results["recommendations_sent"] += 1
+                outgoing.append((customer, message))
+            
+            # Send via Gmail/SMS in batches, while generation runs ahead
+            if len(outgoing) == GMAIL_BATCH_SIZE:
+                queued += len(outgoing)
+                failed += self._send_messages(outgoing)
+                outgoing = []
+        
+        queued += len(outgoing)
+        failed += self._send_messages(outgoing)
+        results["recommendations_sent"] = queued - failed
+        results["errors"] = failed
         
         return results
     
+    def _iter_prefetched(self, fetch, customers: List[Customer], campaign_type: str):
+        """
+        Yield (customer, future) pairs in order while a thread pool runs
+        fetch(signature) up to PREFETCH_WINDOW customers ahead.
+        
+        A pair is yielded once its future is done, so the caller's own
+        work (sending each full Gmail batch) overlaps with generation for
+        the customers behind it. fetch
+        runs once per prompt signature and its future is shared by every
+        customer with that signature for the rest of the campaign, so a
+        failing endpoint is hit once per signature rather than once per
+        customer. Errors raised by fetch surface from future.result().
+        """
+        futures = {}  # One per distinct prompt signature
+        window = deque()
+        
+        with ThreadPoolExecutor(max_workers=CAMPAIGN_WORKERS) as executor:
+            for customer in customers:
+                signature = self._prompt_signature(customer, campaign_type)
+                if signature not in futures:
+                    futures[signature] = executor.submit(fetch, signature)
+                window.append((customer, futures[signature]))
+                
+                if len(window) >= PREFETCH_WINDOW:
+                    ready_customer, future = window.popleft()
+                    wait([future])
+                    yield ready_customer, future
+            
+            while window:
+                ready_customer, future = window.popleft()
+                wait([future])
+                yield ready_customer, future
+    
     # ==================== OPERATIONS INTELLIGENCE ====================
     
     def generate_sales_report(self, store_id: str, period: str = "daily") -> Dict:
@@ -210,27 +483,20 @@ class BobaBotAgent:
             Comprehensive sales report
         """
         # Fetch sales data from Google Sheets
-        sales_data = self._get_sales_data(store_id, period)
+        sales_data = self._as_sales_columns(self._get_sales_data(store_id, period))
         
         report = {
             "store_id": store_id,
             "period": period,
-            "generated_at": datetime.now().isoformat(),
+            "generated_at": self._now_iso(),
             "metrics": {
-                "total_revenue": sum(sale["amount"] for sale in sales_data),
-                "total_transactions": len(sales_data),
-                "average_transaction": 0,
+                **self._summarize(sales_data),
                 "top_selling_items": self._calculate_top_items(sales_data),
                 "peak_hours": self._calculate_peak_hours(sales_data),
                 "loyalty_member_percentage": self._calculate_loyalty_percentage(sales_data)
             }
         }
         
-        if report["metrics"]["total_transactions"] > 0:
-            report["metrics"]["average_transaction"] = (
-                report["metrics"]["total_revenue"] / report["metrics"]["total_transactions"]
-            )
-        
         # Store report in Google Sheets
         self._store_report_in_sheets(report)
         
@@ -256,7 +522,7 @@ class BobaBotAgent:
         inventory_needs = {
             "store_id": store_id,
             "forecast_period": f"{days_ahead} days",
-            "generated_at": datetime.now().isoformat(),
+            "generated_at": self._now_iso(),
             "predictions": predictions,
             "reorder_alerts": self._generate_reorder_alerts(predictions)
         }
@@ -273,35 +539,64 @@ class BobaBotAgent:
         Returns:
             Sentiment analysis results
         """
+        return self.analyze_customer_sentiment_batch([feedback_text])[0]
+    
+    def analyze_customer_sentiment_batch(self, feedback_texts: List[str]) -> List[Dict]:
+        """
+        Analyze many pieces of customer feedback with a single AI call.
+        
+        Args:
+            feedback_texts: Customer reviews or feedback
+            
+        Returns:
+            Sentiment analysis results, one per feedback text
+        """
+        if not feedback_texts:
+            return []
+        
         # Call Vertex AI sentiment analysis via Zapier MCP
         sentiment = self._call_mcp_tool(
-            tool="google_vertex_ai_analyze_text_sentiment",
+            tool="google_vertex_ai_analyze_batch_sentiment",
             params={
-                "text": feedback_text,
-                "instructions": "Analyze the sentiment of this customer feedback"
+                "texts": feedback_texts,
+                "instructions": "Analyze the sentiment of each customer feedback"
             }
         )
         
-        # Take action based on sentiment
-        if sentiment.get("score", 0) < -0.5:  # Negative sentiment
-            # Alert manager
-            self._alert_manager(f"Negative feedback detected: {feedback_text}")
-            
-            # Generate apology email
-            apology = self._generate_apology_email(feedback_text)
+        # Missing scores become NaN, which is neither negative nor positive
+        scores = np.array(sentiment.get("scores") or [], dtype=np.float64)
+        if scores.size != len(feedback_texts):
+            scores = np.full(len(feedback_texts), np.nan)
+        
+        is_negative = scores < -0.5
+        is_positive = scores > 0
+        
+        results = []
+        for text, score, negative, positive in zip(feedback_texts, scores.tolist(), is_negative, is_positive):
+            score = None if np.isnan(score) else score
             
-            return {
-                "sentiment": "negative",
-                "score": sentiment.get("score"),
-                "action_taken": "manager_alerted_and_apology_generated",
-                "apology_email": apology
-            }
+            # Take action based on sentiment
+            if negative:
+                # Alert manager
+                self._alert_manager(f"Negative feedback detected: {text}")
+                
+                # Generate apology email
+                apology = self._generate_apology_email(text)
+                
+                results.append({
+                    "sentiment": "negative",
+                    "score": score,
+                    "action_taken": "manager_alerted_and_apology_generated",
+                    "apology_email": apology
+                })
+            else:
+                results.append({
+                    "sentiment": "positive" if positive else "neutral",
+                    "score": score,
+                    "action_taken": "none"
+                })
         
-        return {
-            "sentiment": "positive" if sentiment.get("score", 0) > 0 else "neutral",
-            "score": sentiment.get("score"),
-            "action_taken": "none"
-        }
+        return results
     
     # ==================== MCP INTEGRATION HELPERS ====================
     
@@ -317,51 +612,161 @@ class BobaBotAgent:
             Tool execution result
         """
         try:
-            # Convert params to JSON string
-            params_json = json.dumps(params)
-            
-            # Call MCP CLI
-            result = subprocess.run(
-                [
-                    "manus-mcp-cli",
-                    "tool",
-                    "call",
-                    tool,
-                    "--server",
-                    self.mcp_server,
-                    "--input",
-                    params_json
-                ],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            
-            if result.returncode == 0:
-                return json.loads(result.stdout)
-            else:
-                print(f"MCP tool error: {result.stderr}")
-                return {"error": result.stderr}
+            return self._tool_caller(tool)(params)
                 
         except Exception as e:
             print(f"Exception calling MCP tool: {e}")
             return {"error": str(e)}
     
-    def _generate_personalized_message(self, customer: Dict, campaign_type: str) -> str:
+    def _build_tool_caller(self, tool: str):
+        """
+        Build the request function for one MCP tool.
+        
+        The tool name is encoded into the request line once per tool, so
+        each call only serializes its params. Cached in _tool_caller.
+        """
+        prefix = b'{"tool":' + _json_dumps(tool) + b',"params":'
+        
+        def call(params: Dict) -> Dict:
+            proc = self._acquire_mcp_process()
+            
+            try:
+                # One JSON request per line, one JSON response per line
+                proc.stdin.write(prefix + _json_dumps(params) + b"}\n")
+                proc.stdin.flush()
+                line = self._read_response_line(proc, MCP_TIMEOUT_SECONDS)
+            except Exception:
+                self._discard_mcp_process(proc)
+                raise
+            
+            if line is None:
+                # A late reply would desync the stream, so drop the process
+                self._discard_mcp_process(proc)
+                print(f"MCP tool error: {tool} timed out")
+                return {"error": f"{tool} timed out"}
+            
+            if not line:
+                self._discard_mcp_process(proc)
+                print("MCP tool error: MCP server exited")
+                return {"error": "MCP server exited"}
+            
+            self._release_mcp_process(proc)
+            return _json_loads(line)
+        
+        return call
+    
+    def _read_response_line(self, proc: "subprocess.Popen", timeout: float) -> Optional[bytes]:
+        """
+        Read one newline-terminated response from an MCP client.
+        
+        Reads the raw pipe against a deadline, so a partial line cannot
+        block past the timeout.
+        
+        Returns:
+            The line, b"" if the process closed its stdout, or None on timeout
+        """
+        fd = proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        chunks = []
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                return None
+            
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b""
+            
+            chunks.append(chunk)
+            if b"\n" in chunk:
+                return b"".join(chunks)
+    
+    def _acquire_mcp_process(self) -> "subprocess.Popen":
+        """
+        Take an idle long-lived MCP client process, starting one if needed.
+        
+        Reusing stdio processes avoids a fork/exec of manus-mcp-cli for
+        every tool call. Each process serves one request at a time, so
+        concurrent callers each get their own.
+        """
+        with self._mcp_lock:
+            while self._mcp_idle:
+                proc = self._mcp_idle.pop()
+                if proc.poll() is None:
+                    return proc
+                proc.wait()
+        
+        import subprocess
+        
+        return subprocess.Popen(
+            ["manus-mcp-cli", "serve", "--server", self.mcp_server],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+    
+    def _release_mcp_process(self, proc: "subprocess.Popen"):
+        """Return an MCP client process to the idle pool."""
+        with self._mcp_lock:
+            self._mcp_idle.append(proc)
+    
+    def _discard_mcp_process(self, proc: "subprocess.Popen"):
+        """Stop an MCP client process and reap it."""
+        _stop_mcp_process(proc)
+    
+    def _close_mcp_processes(self):
+        """Stop all idle MCP client processes."""
+        _stop_idle_mcp_processes(self._mcp_idle, self._mcp_lock)
+    
+    def _prompt_signature(self, customer: Customer, campaign_type: str) -> tuple:
+        """
+        Reduce a customer to the details their AI prompt depends on.
+        
+        Customers with the same signature get the same AI response, so
+        visit counts are bucketed (0-4, 5-9, ..., 50+) and the name is
+        left out; it is added to the final message instead.
+        """
+        visits_bucket = min(customer.total_visits // 5, 10)
+        return (campaign_type, customer.favorite_drink, visits_bucket)
+    
+    def _generate_personalized_message(self, customer: Customer, campaign_type: str) -> str:
         """
         Generate personalized marketing message using AI.
         """
-        prompt = f"""
-        Write a friendly, personalized marketing message in Vietnamese for {customer['name']}.
-        Campaign type: {campaign_type}
-        Customer details:
-        - Favorite drink: {customer.get('favorite_drink', 'unknown')}
-        - Total visits: {customer.get('total_visits', 0)}
-        - Last visit: {customer.get('last_visit', 'unknown')}
+        text = self._message_text(self._prompt_signature(customer, campaign_type))
+        return self._personalize_message(customer, text)
+    
+    def _personalize_message(self, customer: Customer, text: str) -> str:
+        """Address a signature-level message body to one customer."""
+        return f"Hi {customer.name}! {text}"
+    
+    def _message_text(self, signature: tuple) -> str:
+        """
+        Get the (cached) message body for a prompt signature, falling back
+        to a stock offer when Vertex AI fails.
+        """
+        try:
+            return self._cached_message_text(*signature)
+        except LookupError:
+            return "We miss you! Come back for 15% off!"
+    
+    def _generate_message_text(self, campaign_type: str, favorite_drink: Optional[str],
+                               visits_bucket: int) -> str:
+        """
+        Ask Vertex AI for the message body for one prompt signature.
         
-        Keep it warm, casual, and under 100 words.
-        Include a special 15% discount offer.
+        Raises LookupError when no text comes back, so failures are not cached.
         """
+        template = _MESSAGE_PROMPTS.get(campaign_type, _WE_MISS_YOU_PROMPT)
+        prompt = template.format_map({
+            "campaign_type": campaign_type,
+            "drink": favorite_drink or "unknown",
+            "visits": self._describe_visits_bucket(visits_bucket)
+        })
         
         result = self._call_mcp_tool(
             tool="google_vertex_ai_send_prompt",
@@ -371,19 +776,37 @@ class BobaBotAgent:
             }
         )
         
-        return result.get("text", "We miss you! Come back for 15% off!")
+        if "text" not in result:
+            raise LookupError(result.get("error", "No text in AI response"))
+        return result["text"]
     
-    def _get_ai_recommendations(self, customer: Dict) -> List[str]:
+    def _get_ai_recommendations(self, customer: Customer) -> List[str]:
         """
         Get AI-powered product recommendations.
         """
-        prompt = f"""
-        Based on this customer's purchase history, recommend 2-3 new drinks they might enjoy:
-        - Favorite drink: {customer.get('favorite_drink')}
-        - Total visits: {customer.get('total_visits')}
+        return list(self._recommendations_for(self._prompt_signature(customer, "recommendation")))
+    
+    def _recommendations_for(self, signature: tuple) -> tuple:
+        """
+        Get the (cached) recommendations for a prompt signature, or none
+        when Vertex AI fails.
+        """
+        _, favorite_drink, visits_bucket = signature
+        try:
+            return self._cached_recommendations(favorite_drink, visits_bucket)
+        except LookupError:
+            return ()
+    
+    def _generate_recommendations(self, favorite_drink: Optional[str], visits_bucket: int) -> tuple:
+        """
+        Ask Vertex AI for recommendations for one prompt signature.
         
-        Respond with just the drink names, one per line.
+        Raises LookupError when no text comes back, so failures are not cached.
         """
+        prompt = _RECOMMENDATION_PROMPT.format_map({
+            "drink": favorite_drink,
+            "visits": self._describe_visits_bucket(visits_bucket)
+        })
         
         result = self._call_mcp_tool(
             tool="google_vertex_ai_send_prompt",
@@ -393,98 +816,400 @@ class BobaBotAgent:
             }
         )
         
-        recommendations = result.get("text", "").strip().split("\n")
-        return [r.strip() for r in recommendations if r.strip()]
+        if "text" not in result:
+            raise LookupError(result.get("error", "No text in AI response"))
+        recommendations = result["text"].strip().split("\n")
+        return tuple(r.strip() for r in recommendations if r.strip())
+    
+    def _describe_visits_bucket(self, visits_bucket: int) -> str:
+        """Describe a visit count bucket from _prompt_signature, e.g. "5-9"."""
+        low = visits_bucket * 5
+        return f"{low}+" if visits_bucket == 10 else f"{low}-{low + 4}"
     
     # ==================== DATA STORAGE HELPERS ====================
     
-    def _store_customer_in_sheets(self, customer: Dict):
-        """Store customer data in Google Sheets via Zapier MCP."""
-        self._call_mcp_tool(
-            tool="google_sheets_create_spreadsheet_row",
-            params={
-                "instructions": f"Add new customer {customer['name']} to the Customers sheet",
-                "spreadsheet": "BobaBot Customer Database",
-                "worksheet": "Customers"
-            }
+    @contextmanager
+    def batched_writes(self):
+        """
+        Buffer Google Sheets writes and welcome messages, sending them in
+        batches on exit.
+        
+        Outside this context every write is flushed immediately. Nested
+        contexts flush once, when the outermost one exits.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush_writes()
+                self._flush_sends()
+    
+    def flush_writes(self) -> int:
+        """
+        Send all buffered Google Sheets writes.
+        
+        Returns:
+            Number of rows that failed and were re-queued
+        """
+        return self.flush_customer_writes() + self.flush_report_writes()
+    
+    def flush_customer_writes(self) -> int:
+        """
+        Send buffered customer inserts and updates to Google Sheets.
+        
+        Returns:
+            Number of rows that failed and were re-queued
+        """
+        inserts, self._pending_customer_writes = self._pending_customer_writes, []
+        failed_inserts = self._write_rows_in_batches(
+            tool="google_sheets_create_spreadsheet_rows",
+            items=inserts,
+            to_row=Customer.to_dict,
+            instructions="Add these new customers to the Customers sheet",
+            spreadsheet="BobaBot Customer Database",
+            worksheet="Customers"
         )
+        self._pending_customer_writes = failed_inserts + self._pending_customer_writes
+        
+        updates, self._pending_customer_updates = self._pending_customer_updates, {}
+        failed_updates = self._write_rows_in_batches(
+            tool="google_sheets_update_spreadsheet_rows",
+            items=list(updates.values()),
+            to_row=Customer.to_dict,
+            instructions="Update these customers by ID with the new data",
+            spreadsheet="BobaBot Customer Database",
+            worksheet="Customers"
+        )
+        for customer in failed_updates:
+            self._pending_customer_updates.setdefault(customer.id, customer)
+        
+        return len(failed_inserts) + len(failed_updates)
     
-    def _update_customer_in_sheets(self, customer: Dict):
-        """Update customer data in Google Sheets."""
-        self._call_mcp_tool(
-            tool="google_sheets_update_spreadsheet_row",
-            params={
-                "instructions": f"Update customer {customer['id']} with new data",
-                "spreadsheet": "BobaBot Customer Database",
-                "worksheet": "Customers"
-            }
+    def flush_report_writes(self) -> int:
+        """
+        Send buffered sales reports to Google Sheets.
+        
+        Returns:
+            Number of rows that failed and were re-queued
+        """
+        reports, self._pending_report_writes = self._pending_report_writes, []
+        failed = self._write_rows_in_batches(
+            tool="google_sheets_create_spreadsheet_rows",
+            items=reports,
+            to_row=None,
+            instructions="Add these sales reports to the Sales Reports sheet",
+            spreadsheet="BobaBot Reports",
+            worksheet="Sales Reports"
         )
+        self._pending_report_writes = failed + self._pending_report_writes
+        return len(failed)
+    
+    def _write_rows_in_batches(self, tool: str, items: List, to_row, instructions: str,
+                               spreadsheet: str, worksheet: str) -> List:
+        """
+        Write items with one MCP call per SHEETS_BATCH_SIZE rows.
+        
+        Args:
+            items: Objects to write, converted to rows with to_row (None if
+                they are rows already)
+            
+        Returns:
+            Items in chunks the MCP tool rejected (e.g. rate limited), for
+            the caller to re-queue
+        """
+        failed = []
+        for start in range(0, len(items), SHEETS_BATCH_SIZE):
+            chunk = items[start:start + SHEETS_BATCH_SIZE]
+            result = self._call_mcp_tool(
+                tool=tool,
+                params={
+                    "instructions": instructions,
+                    "rows": chunk if to_row is None else [to_row(item) for item in chunk],
+                    "spreadsheet": spreadsheet,
+                    "worksheet": worksheet
+                }
+            )
+            if "error" in result:
+                print(f"Failed to write {len(chunk)} row(s) to {worksheet}, will retry: {result['error']}")
+                failed.extend(chunk)
+        
+        return failed
+    
+    def _store_customer_in_sheets(self, customer: Customer):
+        """Store customer data in Google Sheets via Zapier MCP."""
+        self._pending_customer_writes.append(customer)
+        if self._batch_depth == 0:
+            self.flush_customer_writes()
+    
+    def _update_customer_in_sheets(self, customer: Customer):
+        """Update customer data in Google Sheets."""
+        self._pending_customer_updates[customer.id] = customer
+        if self._batch_depth == 0:
+            self.flush_customer_writes()
     
     def _store_report_in_sheets(self, report: Dict):
         """Store sales report in Google Sheets."""
-        self._call_mcp_tool(
-            tool="google_sheets_create_spreadsheet_row",
-            params={
-                "instructions": f"Add sales report for {report['store_id']}",
-                "spreadsheet": "BobaBot Reports",
-                "worksheet": "Sales Reports"
-            }
-        )
+        self._pending_report_writes.append(report)
+        if self._batch_depth == 0:
+            self.flush_report_writes()
     
     # ==================== UTILITY METHODS ====================
     
+    def _now_iso(self) -> str:
+        """
+        Current time as an ISO string, reused for TIMESTAMP_CACHE_SECONDS.
+        
+        Bursts of sign-ups and purchases share one formatted timestamp
+        instead of formatting a new one per row.
+        """
+        now = time.monotonic()
+        if self._iso_time is None or now - self._iso_time > TIMESTAMP_CACHE_SECONDS:
+            self._iso_cache = _datetime_now().isoformat()
+            self._iso_time = now
+        return self._iso_cache
+    
     def _generate_customer_id(self) -> str:
-        """Generate unique customer ID."""
-        import uuid
-        return f"CUST-{uuid.uuid4().hex[:8].upper()}"
+        """
+        Generate unique customer ID.
+        
+        IDs are only 32 random bits, so draws already in the customer
+        index are retried rather than overwriting a live profile.
+        """
+        while True:
+            customer_id = "CUST-" + token_hex(4).upper()
+            if customer_id not in self._customers:
+                return customer_id
+    
+    def _get_customer(self, customer_id: str) -> Customer:
+        """Retrieve customer, querying Google Sheets only on a local miss."""
+        customer = self._customers.get(customer_id)
+        if customer is None:
+            customer = self._fetch_customer_from_sheets(customer_id)
+            self._customers[customer_id] = customer
+            self._customer_frame = None
+        return customer
     
-    def _get_customer(self, customer_id: str) -> Dict:
-        """Retrieve customer from database."""
+    def _fetch_customer_from_sheets(self, customer_id: str) -> Customer:
+        """Fetch a customer profile from Google Sheets."""
         # In production, query Google Sheets
-        return {"id": customer_id, "name": "Sample Customer"}
+        return Customer(id=customer_id, name="Sample Customer")
     
-    def _get_inactive_customers(self, days: int) -> List[Dict]:
+    def _refresh_customer_frame(self):
+        """
+        Snapshot customers into NumPy columns for vectorized cohort filters.
+        
+        The snapshot is dropped whenever a customer is added or updated,
+        and rebuilt on next use.
+        """
+        customers = list(self._customers.values())
+        birthdays = [self._parse_birthday(c.birthday) for c in customers]
+        
+        self._customer_frame = {
+            "id": np.array([c.id for c in customers], dtype=object),
+            # -1 when the customer has never visited
+            "last_visit_epoch": np.array([self._visit_epoch(c) for c in customers], dtype=np.int64),
+            # 0 when the birthday is unknown or unparseable
+            "birthday_month": np.array([b.month if b else 0 for b in birthdays], dtype=np.int8),
+            "birthday_day": np.array([b.day if b else 0 for b in birthdays], dtype=np.int8)
+        }
+    
+    def _parse_birthday(self, birthday: Optional[str]) -> Optional[date]:
+        """Parse a "YYYY-MM-DD" birthday, or return None if missing or invalid."""
+        if not birthday:
+            return None
+        try:
+            return date.fromisoformat(birthday)
+        except (TypeError, ValueError):
+            return None
+    
+    def _normalize_birthday(self, birthday: Optional[str]) -> Optional[str]:
+        """Validate a sign-up birthday, dropping values that aren't "YYYY-MM-DD"."""
+        parsed = self._parse_birthday(birthday)
+        if birthday and parsed is None:
+            print(f"Ignoring invalid birthday: {birthday!r}")
+        return parsed.isoformat() if parsed else None
+    
+    def _visit_epoch(self, customer: Customer) -> int:
+        """Last visit as Unix seconds, or -1 if never visited or unparseable."""
+        if customer.last_visit_epoch is not None:
+            return customer.last_visit_epoch
+        if customer.last_visit:
+            # Profiles without the epoch field, e.g. loaded from Google Sheets
+            try:
+                return int(datetime.fromisoformat(customer.last_visit).timestamp())
+            except (TypeError, ValueError):
+                return -1
+        return -1
+    
+    def _get_customer_frame(self) -> Dict[str, np.ndarray]:
+        """
+        Return the customer snapshot, rebuilding it if stale.
+        
+        The snapshot only changes with the customers, so the clock that
+        cohort queries compare against is refreshed on every call.
+        """
+        self._now = _datetime_now()
+        self._now_epoch = int(self._now.timestamp())
+        if self._customer_frame is None:
+            self._refresh_customer_frame()
+        return self._customer_frame
+    
+    def _rows_where(self, mask: np.ndarray) -> List[Customer]:
+        """Return the customer profiles selected by a customer frame mask."""
+        return [self._customers[customer_id] for customer_id in self._customer_frame["id"][mask]]
+    
+    def _get_inactive_customers(self, days: int) -> List[Customer]:
         """Get customers inactive for specified days."""
-        # In production, query Google Sheets with date filter
-        return []
+        frame = self._get_customer_frame()
+        last_visit = frame["last_visit_epoch"]
+        mask = (last_visit >= 0) & (last_visit < self._now_epoch - days * 86400)
+        return self._rows_where(mask)
     
-    def _get_birthday_customers(self) -> List[Dict]:
+    def _get_birthday_customers(self) -> List[Customer]:
         """Get customers with birthdays today."""
-        return []
+        frame = self._get_customer_frame()
+        mask = (frame["birthday_month"] == self._now.month) & (frame["birthday_day"] == self._now.day)
+        return self._rows_where(mask)
     
-    def _get_recent_customers(self, days: int) -> List[Dict]:
+    def _get_recent_customers(self, days: int) -> List[Customer]:
         """Get customers who visited recently."""
-        return []
+        frame = self._get_customer_frame()
+        mask = frame["last_visit_epoch"] >= self._now_epoch - days * 86400
+        return self._rows_where(mask)
+    
+    def _queue_message(self, customer: Customer, message: str):
+        """Queue a message for the next batched Gmail/SMS send."""
+        self._pending_sends.append((customer, message))
+    
+    # Fire-and-forget sends (welcome messages) are queued; callers flush with _flush_sends()
+    _send_message = _queue_message
+    
+    def _flush_sends(self) -> int:
+        """
+        Send all queued messages.
+        
+        Returns:
+            Number of messages that could not be sent
+        """
+        pending, self._pending_sends = self._pending_sends, []
+        return self._send_messages(pending)
     
-    def _send_message(self, customer: Dict, message: str):
-        """Send message via Gmail/SMS."""
-        print(f"Sending to {customer['name']}: {message}")
+    def _send_messages(self, messages: List[tuple]) -> int:
+        """
+        Send (customer, message) pairs with one MCP call per GMAIL_BATCH_SIZE.
+        
+        Customers without an email address are skipped, so one missing
+        address cannot get a whole batch rejected.
+        
+        Returns:
+            Number of messages that could not be sent
+        """
+        deliverable = [(customer, message) for customer, message in messages if customer.email]
+        failed = len(messages) - len(deliverable)
+        if failed:
+            print(f"Skipping {failed} message(s) to customers without an email address")
+        
+        for start in range(0, len(deliverable), GMAIL_BATCH_SIZE):
+            chunk = deliverable[start:start + GMAIL_BATCH_SIZE]
+            print(f"Sending {len(chunk)} message(s)")
+            result = self._call_mcp_tool(
+                tool="google_gmail_send_batch_emails",
+                params={
+                    "messages": [
+                        {"to": customer.email, "body": message}
+                        for customer, message in chunk
+                    ]
+                }
+            )
+            if "error" in result:
+                print(f"Failed to send {len(chunk)} message(s): {result['error']}")
+                failed += len(chunk)
+        
+        return failed
     
-    def _send_welcome_message(self, customer: Dict):
+    def _send_welcome_message(self, customer: Customer):
         """Send welcome message to new customer."""
-        message = f"Welcome to Boba Club, {customer['name']}! You've earned 100 points!"
+        message = f"Welcome to Boba Club, {customer.name}! You've earned 100 points!"
         self._send_message(customer, message)
+        if self._batch_depth == 0:
+            self._flush_sends()
     
-    def _check_milestone_rewards(self, customer: Dict):
+    def _check_milestone_rewards(self, customer: Customer):
         """Check if customer reached a milestone."""
-        if customer["total_visits"] in [5, 10, 25, 50, 100]:
-            print(f"Milestone! {customer['name']} reached {customer['total_visits']} visits!")
+        if customer.total_visits in _MILESTONES:
+            print(f"Milestone! {customer.name} reached {customer.total_visits} visits!")
     
-    def _get_sales_data(self, store_id: str, period: str) -> List[Dict]:
-        """Fetch sales data from Google Sheets."""
-        return []
+    def _get_sales_data(self, store_id: str, period: str) -> SalesColumns:
+        """
+        Fetch sales data from Google Sheets.
+        
+        Returns columns rather than one dict per sale, so reports can
+        aggregate with vectorized NumPy operations:
+        - amount, hour, is_loyalty: one entry per transaction
+        - item_id: one entry per item sold (index into MENU_ITEMS)
+        """
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in SALES_DTYPES.items()}
+    
+    def _as_sales_columns(self, sales_data: Dict) -> SalesColumns:
+        """
+        Validate sales columns and convert them to their SALES_DTYPES.
+        
+        Values are checked against SALES_COLUMN_RULES before converting,
+        so bad data is rejected instead of being silently cast (e.g. hour
+        300 wrapping around in int8, or item ID 1.9 truncating to 1).
+        
+        Raises:
+            ValueError: If a column has the wrong type or out-of-range values
+        """
+        columns = {}
+        for name, dtype in SALES_DTYPES.items():
+            values = np.asarray(sales_data[name])
+            if values.size == 0:
+                columns[name] = np.zeros(0, dtype=dtype)
+                continue
+            
+            kinds, value_range = SALES_COLUMN_RULES[name]
+            if values.dtype.kind not in kinds:
+                raise ValueError(f"Sales column {name!r} has invalid type {values.dtype}")
+            if values.dtype.kind == "f" and not np.isfinite(values).all():
+                raise ValueError(f"Sales column {name!r} has non-finite values")
+            if value_range is not None:
+                low, high = value_range
+                if values.min() < low or values.max() > high:
+                    raise ValueError(f"Sales column {name!r} has values outside {low}-{high}")
+            
+            columns[name] = np.ascontiguousarray(values, dtype=dtype)
+        return columns
+    
+    def _summarize(self, sales_data: SalesColumns) -> Dict:
+        """Calculate revenue, transaction count and average transaction."""
+        amount = sales_data["amount"]
+        total = float(np.add.reduce(amount))
+        count = int(amount.size)
+        return {
+            "total_revenue": total,
+            "total_transactions": count,
+            "average_transaction": total / count if count else 0
+        }
     
-    def _calculate_top_items(self, sales_data: List[Dict]) -> List[str]:
+    def _calculate_top_items(self, sales_data: SalesColumns) -> List[str]:
         """Calculate top-selling items."""
-        return ["Taro Milk Tea", "Brown Sugar Boba", "Mango Smoothie"]
+        counts = np.bincount(sales_data["item_id"], minlength=len(MENU_ITEMS))
+        return [MENU_ITEMS[i] for i in _top_k(counts, 3)]
     
-    def _calculate_peak_hours(self, sales_data: List[Dict]) -> List[str]:
+    def _calculate_peak_hours(self, sales_data: SalesColumns) -> List[str]:
         """Calculate peak sales hours."""
-        return ["2pm-4pm", "7pm-9pm"]
+        counts = np.bincount(sales_data["hour"] // 2, minlength=len(PEAK_WINDOW_LABELS))
+        return [PEAK_WINDOW_LABELS[i] for i in _top_k(counts, 2)]
     
-    def _calculate_loyalty_percentage(self, sales_data: List[Dict]) -> float:
+    def _calculate_loyalty_percentage(self, sales_data: SalesColumns) -> float:
         """Calculate percentage of sales from loyalty members."""
-        return 35.5
+        is_loyalty = sales_data["is_loyalty"]
+        if is_loyalty.size == 0:
+            return 0.0
+        return round(float(is_loyalty.mean()) * 100, 1)
     
     def _get_historical_sales(self, store_id: str, days: int) -> List[Dict]:
         """Get historical sales data."""
@@ -506,14 +1231,14 @@ class BobaBotAgent:
         """Generate apology email for negative feedback."""
         return "We're sorry for your experience. Please accept this free drink coupon."
     
-    def _generate_birthday_message(self, customer: Dict, offer: Dict) -> str:
+    def _generate_birthday_message(self, customer: Customer, offer: Dict) -> str:
         """Generate birthday message."""
-        return f"Happy Birthday {customer['name']}! Enjoy a free {offer['item']} on us!"
+        return f"Happy Birthday {customer.name}! Enjoy a free {offer['item']} on us!"
     
-    def _generate_recommendation_message(self, customer: Dict, recommendations: List[str]) -> str:
+    def _generate_recommendation_message(self, customer: Customer, recommendations: List[str]) -> str:
         """Generate recommendation message."""
         items = ", ".join(recommendations)
-        return f"Hi {customer['name']}! Based on your taste, you might love: {items}"
+        return f"Hi {customer.name}! Based on your taste, you might love: {items}"
 
 
 # ==================== MAIN EXECUTION ====================
@@ -532,7 +1257,7 @@ if __name__ == "__main__":
         "email": "nguyen@example.com",
         "favorite_drink": "Taro Milk Tea"
     })
-    print(f"✅ Customer created: {new_customer['id']}")
+    print(f"✅ Customer created: {new_customer.id}")
     
     # Demo: Run marketing campaigns
     print("\n📧 Demo: Running marketing campaigns...")
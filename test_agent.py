@@ -0,0 +1,447 @@
+"""
+Tests for the BobaBot core agent.
+"""
+
+import gc
+import os
+import stat
+import sys
+import time
+import weakref
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import agent
+from agent import BobaBotAgent
+
+
+def _install_fake_mcp_cli(tmp_path, monkeypatch, body: str):
+    """Put a fake manus-mcp-cli running `body` first on PATH."""
+    script = tmp_path / "manus-mcp-cli"
+    script.write_text(f"#!{sys.executable}\nimport json, sys, time\n{body}\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+# ==================== MCP CLIENT ====================
+
+def test_mcp_call_round_trip(tmp_path, monkeypatch):
+    _install_fake_mcp_cli(tmp_path, monkeypatch, """
+for line in sys.stdin:
+    request = json.loads(line)
+    print(json.dumps({"tool": request["tool"], "echo": request["params"]}), flush=True)
+""")
+    bot = BobaBotAgent()
+
+    assert bot._call_mcp_tool("some_tool", {"a": 1}) == {"tool": "some_tool", "echo": {"a": 1}}
+    assert bot._call_mcp_tool("some_tool", {"a": 2})["echo"] == {"a": 2}
+    assert len(bot._mcp_idle) == 1  # One process reused for both calls
+
+    bot._close_mcp_processes()
+
+
+def test_mcp_call_times_out_on_partial_line(tmp_path, monkeypatch):
+    _install_fake_mcp_cli(tmp_path, monkeypatch, """
+sys.stdin.readline()
+sys.stdout.write('{"partial": ')
+sys.stdout.flush()
+time.sleep(60)
+""")
+    monkeypatch.setattr(agent, "MCP_TIMEOUT_SECONDS", 0.5)
+    bot = BobaBotAgent()
+
+    started = time.monotonic()
+    result = bot._call_mcp_tool("slow_tool", {})
+
+    assert result == {"error": "slow_tool timed out"}
+    assert time.monotonic() - started < 10
+    assert bot._mcp_idle == []
+
+
+def test_collected_agent_stops_idle_mcp_processes(tmp_path, monkeypatch):
+    _install_fake_mcp_cli(tmp_path, monkeypatch, """
+for line in sys.stdin:
+    print(json.dumps({"status": "ok"}), flush=True)
+""")
+    bot = BobaBotAgent()
+    bot._call_mcp_tool("some_tool", {})
+    proc = bot._mcp_idle[0]
+    ref = weakref.ref(bot)
+
+    del bot
+    gc.collect()
+
+    assert ref() is None
+    assert proc.returncode is not None
+
+
+def test_mcp_call_reports_exited_server(tmp_path, monkeypatch):
+    _install_fake_mcp_cli(tmp_path, monkeypatch, "sys.exit(0)")
+    bot = BobaBotAgent()
+
+    assert "error" in bot._call_mcp_tool("any_tool", {})
+    assert bot._mcp_idle == []
+
+
+# ==================== CUSTOMER COHORTS ====================
+
+NOW = datetime(2026, 10, 14, 12, 0, 0)
+DAY = 86400
+
+
+@pytest.fixture
+def offline_bot(monkeypatch):
+    """Agent with MCP calls stubbed out and a fixed clock."""
+    monkeypatch.setattr(agent, "_datetime_now", lambda: NOW)
+    bot = BobaBotAgent()
+    bot._call_mcp_tool = lambda tool, params: {"text": "Xin chao"}
+    return bot
+
+
+def _customer_last_seen(bot, name, days_ago):
+    customer = bot.capture_customer({"name": name, "email": f"{name}@example.com"})
+    customer.last_visit_epoch = int(NOW.timestamp()) - days_ago
+    return customer
+
+
+def test_capture_customer_retries_colliding_ids(offline_bot, monkeypatch):
+    draws = iter(["aaaaaaaa", "aaaaaaaa", "bbbbbbbb"])
+    monkeypatch.setattr(agent, "token_hex", lambda nbytes: next(draws))
+
+    first = offline_bot.capture_customer({"name": "A"})
+    second = offline_bot.capture_customer({"name": "B"})
+
+    assert (first.id, second.id) == ("CUST-AAAAAAAA", "CUST-BBBBBBBB")
+    assert offline_bot._customers == {first.id: first, second.id: second}
+
+
+def test_capture_customer_ignores_invalid_birthday(offline_bot):
+    customer = offline_bot.capture_customer({"name": "A", "birthday": "14/10/1990"})
+
+    assert customer.birthday is None
+    assert offline_bot._get_birthday_customers() == []
+
+
+def test_birthday_cohort_skips_unparseable_stored_birthdays(offline_bot):
+    valid = offline_bot.capture_customer({"name": "A", "birthday": "1990-10-14"})
+    corrupt = offline_bot.capture_customer({"name": "B"})
+    corrupt.birthday = "14/10/1990"  # e.g. loaded from Google Sheets
+
+    assert offline_bot._get_birthday_customers() == [valid]
+    results = offline_bot.run_marketing_campaigns()
+    assert results[1]["target_count"] == 1
+
+
+def test_visit_cohorts_skip_unparseable_stored_last_visits(offline_bot):
+    valid = offline_bot.capture_customer({"name": "A"})
+    valid.last_visit = (NOW - timedelta(days=40)).isoformat()
+    corrupt = offline_bot.capture_customer({"name": "B"})
+    corrupt.last_visit = "14/10/2026 10:00"  # e.g. loaded from Google Sheets
+
+    assert offline_bot._get_inactive_customers(days=30) == [valid]
+    assert offline_bot._get_recent_customers(days=7) == []
+    results = offline_bot.run_marketing_campaigns()
+    assert results[0]["target_count"] == 1
+
+
+def test_cohorts_use_current_clock_with_unchanged_snapshot(offline_bot, monkeypatch):
+    customer = _customer_last_seen(offline_bot, "a", 29 * DAY)
+    offline_bot._customer_frame = None
+    assert offline_bot._get_inactive_customers(days=30) == []
+
+    monkeypatch.setattr(agent, "_datetime_now", lambda: NOW + timedelta(days=2))
+
+    assert offline_bot._get_inactive_customers(days=30) == [customer]
+
+
+def test_never_visited_customer_is_in_no_visit_cohort(offline_bot):
+    offline_bot.capture_customer({"name": "A"})
+
+    assert offline_bot._get_inactive_customers(days=30) == []
+    assert offline_bot._get_recent_customers(days=7) == []
+
+
+def test_inactive_cohort_boundary(offline_bot):
+    exactly_30 = _customer_last_seen(offline_bot, "exactly30", 30 * DAY)
+    over_30 = _customer_last_seen(offline_bot, "over30", 30 * DAY + 1)
+    offline_bot._customer_frame = None
+
+    inactive = offline_bot._get_inactive_customers(days=30)
+
+    assert over_30 in inactive
+    assert exactly_30 not in inactive
+
+
+def test_recent_cohort_boundary(offline_bot):
+    exactly_7 = _customer_last_seen(offline_bot, "exactly7", 7 * DAY)
+    over_7 = _customer_last_seen(offline_bot, "over7", 7 * DAY + 1)
+    offline_bot._customer_frame = None
+
+    recent = offline_bot._get_recent_customers(days=7)
+
+    assert exactly_7 in recent
+    assert over_7 not in recent
+
+
+# ==================== SHEETS WRITES ====================
+
+def _record_sheets_calls(bot, result=None):
+    """Record each Sheets MCP call as (tool, row names or IDs)."""
+    calls = []
+
+    def call(tool, params):
+        if tool.startswith("google_sheets_"):
+            calls.append((tool, [row.get("name", row.get("id")) for row in params["rows"]]))
+            return result or {"status": "ok"}
+        return {"status": "ok"}
+
+    bot._call_mcp_tool = call
+    return calls
+
+
+def test_nested_batched_writes_flush_once_at_outermost_exit(offline_bot):
+    calls = _record_sheets_calls(offline_bot)
+
+    with offline_bot.batched_writes():
+        offline_bot.capture_customer({"name": "a"})
+        with offline_bot.batched_writes():
+            offline_bot.capture_customer({"name": "b"})
+        assert calls == []
+        offline_bot.capture_customer({"name": "c"})
+
+    assert calls == [("google_sheets_create_spreadsheet_rows", ["a", "b", "c"])]
+
+
+def test_batched_updates_keep_latest_per_customer(offline_bot):
+    customer = offline_bot.capture_customer({"name": "a"})
+    calls = _record_sheets_calls(offline_bot)
+
+    with offline_bot.batched_writes():
+        offline_bot.track_purchase(customer.id, {"total_amount": 5.0})
+        offline_bot.track_purchase(customer.id, {"total_amount": 5.0})
+
+    assert calls == [("google_sheets_update_spreadsheet_rows", ["a"])]
+    assert customer.total_visits == 2
+
+
+def test_batched_writes_are_chunked(offline_bot, monkeypatch):
+    monkeypatch.setattr(agent, "SHEETS_BATCH_SIZE", 2)
+    calls = _record_sheets_calls(offline_bot)
+
+    with offline_bot.batched_writes():
+        for name in "abcde":
+            offline_bot.capture_customer({"name": name})
+
+    assert [rows for _, rows in calls] == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_rejected_sheets_batch_is_requeued(offline_bot):
+    _record_sheets_calls(offline_bot, {"error": "429 Too Many Requests"})
+    with offline_bot.batched_writes():
+        offline_bot.capture_customer({"name": "a"})
+        offline_bot.capture_customer({"name": "b"})
+
+    assert [c.name for c in offline_bot._pending_customer_writes] == ["a", "b"]
+
+    calls = _record_sheets_calls(offline_bot)
+    assert offline_bot.flush_writes() == 0
+    assert calls == [("google_sheets_create_spreadsheet_rows", ["a", "b"])]
+    assert offline_bot._pending_customer_writes == []
+
+
+# ==================== SALES REPORTS ====================
+
+def _sales(**overrides):
+    sales = {
+        "amount": [5.0, 6.0, 7.5],
+        "hour": [14, 15, 19],
+        "is_loyalty": [True, False, True],
+        "item_id": [0, 0, 2, 1, 2, 2]
+    }
+    sales.update(overrides)
+    return sales
+
+
+def test_sales_report_metrics(offline_bot):
+    offline_bot._get_sales_data = lambda store_id, period: _sales()
+
+    metrics = offline_bot.generate_sales_report("STORE-001")["metrics"]
+
+    assert metrics["total_revenue"] == 18.5
+    assert metrics["total_transactions"] == 3
+    assert metrics["top_selling_items"] == ["Mango Smoothie", "Taro Milk Tea", "Brown Sugar Boba"]
+    assert metrics["peak_hours"] == ["2pm-4pm", "6pm-8pm"]
+    assert metrics["loyalty_member_percentage"] == 66.7
+
+
+@pytest.mark.parametrize("overrides", [
+    {"hour": [300, 15, 19]},
+    {"item_id": [1.9]},
+    {"item_id": [len(agent.MENU_ITEMS)]},
+    {"is_loyalty": ["False", "True", "True"]},
+    {"amount": ["5.0", "6.0", "7.5"]},
+    {"amount": [5.0, float("nan"), 7.5]}
+])
+def test_sales_columns_reject_bad_data(offline_bot, overrides):
+    with pytest.raises(ValueError):
+        offline_bot._as_sales_columns(_sales(**overrides))
+
+
+@pytest.mark.parametrize("counts, k, expected", [
+    ([0, 3, 1, 0, 1, 1], 3, [1, 2, 4]),
+    ([2, 2, 2, 2], 2, [0, 1]),
+    ([0, 0, 5, 0, 5, 0, 0, 0, 0, 0, 0, 5], 2, [2, 4]),
+    ([0, 1, 0], 3, [1]),
+    ([], 2, [])
+])
+def test_top_k_breaks_ties_by_index(counts, k, expected):
+    assert agent._top_k(np.array(counts, dtype=np.int64), k).tolist() == expected
+
+
+# ==================== CAMPAIGN SENDS ====================
+
+def _campaign_bot(bot, send_result):
+    """Route Gmail batch sends to a recorder returning `send_result`."""
+    sent = []
+
+    def call(tool, params):
+        if tool == "google_gmail_send_batch_emails":
+            sent.extend(message["to"] for message in params["messages"])
+            return send_result
+        return {"text": "Xin chao"}
+
+    bot._call_mcp_tool = call
+    return sent
+
+
+def test_campaign_skips_customers_without_email(offline_bot):
+    with_email = _customer_last_seen(offline_bot, "a", 31 * DAY)
+    without_email = _customer_last_seen(offline_bot, "b", 31 * DAY)
+    without_email.email = None
+    offline_bot._customer_frame = None
+    sent = _campaign_bot(offline_bot, {"status": "ok"})
+
+    results = offline_bot._run_we_miss_you_campaign()
+
+    assert sent == [with_email.email]
+    assert results["messages_sent"] == 1
+    assert results["errors"] == 1
+
+
+def test_campaign_counts_failed_batch_as_errors(offline_bot):
+    _customer_last_seen(offline_bot, "a", 31 * DAY)
+    _customer_last_seen(offline_bot, "b", 3 * DAY)
+    offline_bot._customer_frame = None
+    _campaign_bot(offline_bot, {"error": "quota exceeded"})
+
+    we_miss_you, _, recommendations = offline_bot.run_marketing_campaigns()
+
+    assert (we_miss_you["messages_sent"], we_miss_you["errors"]) == (0, 1)
+    assert (recommendations["recommendations_sent"], recommendations["errors"]) == (0, 1)
+
+
+def test_campaign_calls_failing_vertex_once_per_signature(offline_bot):
+    for name in ("a", "b", "c"):
+        _customer_last_seen(offline_bot, name, 31 * DAY)
+    offline_bot._customer_frame = None
+    prompts = []
+
+    def call(tool, params):
+        if tool == "google_vertex_ai_send_prompt":
+            prompts.append(params["prompt"])
+            return {"error": "vertex unavailable"}
+        return {"status": "ok"}
+
+    offline_bot._call_mcp_tool = call
+
+    results = offline_bot._run_we_miss_you_campaign()
+
+    assert len(prompts) == 1  # All three customers share one signature
+    assert results["messages_sent"] == 3
+
+
+def test_campaign_sends_full_batches_during_the_loop(offline_bot, monkeypatch):
+    monkeypatch.setattr(agent, "GMAIL_BATCH_SIZE", 2)
+    for name in "abcde":
+        _customer_last_seen(offline_bot, name, 31 * DAY)
+    offline_bot._customer_frame = None
+    batches = []
+
+    def call(tool, params):
+        if tool == "google_gmail_send_batch_emails":
+            batches.append(len(params["messages"]))
+        return {"text": "Xin chao"}
+
+    offline_bot._call_mcp_tool = call
+
+    results = offline_bot._run_we_miss_you_campaign()
+
+    assert batches == [2, 2, 1]
+    assert (results["messages_sent"], results["errors"]) == (5, 0)
+
+
+# ==================== CUSTOMER SENTIMENT ====================
+
+def _sentiment_bot(bot, response):
+    """Answer sentiment calls with `response`, recording each call's texts."""
+    calls = []
+
+    def call(tool, params):
+        calls.append((tool, params["texts"]))
+        return response
+
+    bot._call_mcp_tool = call
+    return calls
+
+
+def test_sentiment_batch_classifies_each_score(offline_bot):
+    calls = _sentiment_bot(offline_bot, {"scores": [-0.9, 0.7, 0.0, -0.5]})
+
+    results = offline_bot.analyze_customer_sentiment_batch(["awful", "great", "ok", "meh"])
+
+    assert calls == [("google_vertex_ai_analyze_batch_sentiment", ["awful", "great", "ok", "meh"])]
+    assert [r["sentiment"] for r in results] == ["negative", "positive", "neutral", "neutral"]
+    assert [r["score"] for r in results] == [-0.9, 0.7, 0.0, -0.5]
+    assert results[0]["action_taken"] == "manager_alerted_and_apology_generated"
+    assert "apology_email" in results[0]
+    assert {r["action_taken"] for r in results[1:]} == {"none"}
+
+
+def test_sentiment_batch_missing_scores_are_neutral(offline_bot):
+    _sentiment_bot(offline_bot, {"scores": [None, 0.4]})
+
+    results = offline_bot.analyze_customer_sentiment_batch(["?", "nice"])
+
+    assert results[0] == {"sentiment": "neutral", "score": None, "action_taken": "none"}
+    assert results[1]["sentiment"] == "positive"
+
+
+@pytest.mark.parametrize("response", [
+    {"scores": [0.9]},
+    {"scores": [0.9, 0.9, 0.9]},
+    {"error": "quota exceeded"}
+])
+def test_sentiment_batch_without_matching_scores_is_neutral(offline_bot, response):
+    _sentiment_bot(offline_bot, response)
+
+    results = offline_bot.analyze_customer_sentiment_batch(["a", "b"])
+
+    assert results == [{"sentiment": "neutral", "score": None, "action_taken": "none"}] * 2
+
+
+def test_sentiment_batch_of_nothing_makes_no_call(offline_bot):
+    calls = _sentiment_bot(offline_bot, {"scores": []})
+
+    assert offline_bot.analyze_customer_sentiment_batch([]) == []
+    assert calls == []
+
+
+def test_single_sentiment_uses_batch_tool(offline_bot):
+    calls = _sentiment_bot(offline_bot, {"scores": [-0.8]})
+
+    result = offline_bot.analyze_customer_sentiment("cold boba")
+
+    assert calls == [("google_vertex_ai_analyze_batch_sentiment", ["cold boba"])]
+    assert (result["sentiment"], result["score"]) == ("negative", -0.8)